@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+
+'''
+Utilities shared by the CI/CD scripts
+
+'''
+
+import functools
+import platform
+import sys
+
+
+@functools.lru_cache(maxsize=1)
+def get_platform():
+    ''' Return the Anaconda platform name for the current platform '''
+    plat = platform.system().lower()
+    if 'darwin' in plat:
+        return 'osx-64'
+    if plat.startswith('win'):
+        return 'win-64'
+    if 'linux' in plat:
+        machine = platform.machine().lower()
+        if 'x86' in machine:
+            return 'linux-64'
+        if 'ppc' in machine:
+            return 'linux-ppc64le'
+    return 'unknown'
+
+
+def print_err(*args, **kwargs):
+    ''' Print a message to stderr '''
+    sys.stderr.write(*args, **kwargs)
+    sys.stderr.write('\n')
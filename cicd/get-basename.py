@@ -15,33 +15,14 @@ specified, the platform the program is running on is used.
 '''
 
 import argparse
-import glob
 import os
-import platform
 import re
 import sys
 
+from _common import get_platform, print_err
 
-def get_platform():
-    ''' Return the Anaconda platform name for the current platform '''
-    plat = platform.system().lower()
-    if 'darwin' in plat:
-        return 'osx-64'
-    if plat.startswith('win'):
-        return 'win-64'
-    if 'linux' in plat:
-        machine = platform.machine().lower()
-        if 'x86' in machine:
-            return 'linux-64'
-        if 'ppc' in machine:
-            return 'linux-ppc64le'
-    return 'unknown'
-
-
-def print_err(*args, **kwargs):
-    ''' Print a message to stderr '''
-    sys.stderr.write(*args, **kwargs)
-    sys.stderr.write('\n')
+_VERSION_RE = re.compile(r'''^Version\s*:\s*(\S+)''')
+_TKVERSION_RE = re.compile(r'''^TKVersion\s*:\s*(\S+)''')
 
 
 def main(args):
@@ -50,18 +31,27 @@ def main(args):
     version = None
     tk_version = None
 
-    init = glob.glob(os.path.join(args.root, 'DESCRIPTION'))[0]
+    init = os.path.join(args.root, 'DESCRIPTION')
+    if not os.path.isfile(init):
+        print_err('ERROR: Could not find DESCRIPTION file.')
+        return 1
+
     with open(init, 'r') as init_in:
         for line in init_in:
-            m = re.search(r'''^Version\s*:\s*(\S+)''', line)
-            if m:
-                version = m.group(1)
-
-            m = re.search(r'''^TKVersion\s*:\s*(\S+)''', line)
-            if m:
-                tk_version = m.group(1)
-                if tk_version == 'none':
-                    tk_version = 'REST-only'
+            if line.startswith('Version'):
+                m = _VERSION_RE.match(line)
+                if m:
+                    version = m.group(1)
+
+            elif line.startswith('TKVersion'):
+                m = _TKVERSION_RE.match(line)
+                if m:
+                    tk_version = m.group(1)
+                    if tk_version == 'none':
+                        tk_version = 'REST-only'
+
+            if version is not None and tk_version is not None:
+                break
 
     if version:
         if args.full:
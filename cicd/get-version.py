@@ -8,16 +8,13 @@ Return the version of the package
 from __future__ import print_function, division, absolute_import, unicode_literals
 
 import argparse
-import glob
 import os
 import re
 import sys
 
+from _common import print_err
 
-def print_err(*args, **kwargs):
-    ''' Print a message to stderr '''
-    sys.stderr.write(*args, **kwargs)
-    sys.stderr.write('\n')
+_VERSION_RE = re.compile(r'''^Version\s*:\s*(\S+)''')
 
 
 def main(args):
@@ -25,12 +22,19 @@ def main(args):
 
     version = None
 
-    init = glob.glob(os.path.join(args.root, 'DESCRIPTION'))[0]
+    init = os.path.join(args.root, 'DESCRIPTION')
+    if not os.path.isfile(init):
+        print_err('ERROR: Could not find DESCRIPTION file.')
+        return 1
+
     with open(init, 'r') as init_in:
         for line in init_in:
-            m = re.search(r'''^Version\s*:\s*(\S+)''', line)
+            if not line.startswith('Version'):
+                continue
+            m = _VERSION_RE.match(line)
             if m:
                 version = m.group(1)
+                break
 
     if version:
         if args.as_expr:
@@ -5,35 +5,29 @@
 from __future__ import print_function, division, absolute_import, unicode_literals
 
 import argparse
+import concurrent.futures
 import contextlib
-import glob
 import io
 import json
 import os
-import platform
 import re
 import shutil
 import subprocess
 import sys
 import tarfile
 import tempfile
-from urllib.request import urlretrieve, urlcleanup
+from urllib.request import urlopen
 
+from _common import get_platform
 
-def get_platform():
-    ''' Return the Anaconda platform name for the current platform '''
-    plat = platform.system().lower()
-    if 'darwin' in plat:
-        return 'osx-64'
-    if plat.startswith('win'):
-        return 'win-64'
-    if 'linux' in plat:
-        machine = platform.machine().lower()
-        if 'x86' in machine:
-            return 'linux-64'
-        if 'ppc' in machine:
-            return 'linux-ppc64le'
-    return 'unknown'
+_VERSION_RE = re.compile(r'''^Version\s*:\s*(\S+)''')
+_MINOR_VERSION_RE = re.compile(r'''^(\d+\.\d+)''')
+_DIGITS_RE = re.compile(r'''(\d+)''')
+_SPEC_RE = re.compile(r'''^([<>=!]*)(\S+)$''')
+_SHA256_RE = re.compile(r'''^.*sha256.*\n?''', re.M)
+_TRAILING_WS_RE = re.compile(r'''[ \t]+$''', re.M)
+_SET_TEMPLATE = r'''^(\{%%[ \t]*set[ \t]+%s[ \t]*=[ \t]*)'[^'\n]+'([ \t]*%%\}[ \t]*)$'''
+_URL_RE = re.compile(r'''^([ \t]+)(?:url|path):.*?([ \t]*#[ \t]*\[.+?\][ \t]*)?$''', re.M)
 
 
 def update_recipe(recipe, **kwargs):
@@ -53,49 +47,42 @@ def update_recipe(recipe, **kwargs):
         recipe = os.path.join(recipe, 'meta.yaml')
 
     params = kwargs.copy()
-    for name, value in params.items():
-        if name == 'url':
-            url = value
-            continue
+    url = params.pop('url', None)
+
+    # Compile substitutions once and apply each to the entire recipe
+    subs = [(_SHA256_RE, '')]
+    if url:
+        url = url.replace('\\', '/')
+        if os.path.isdir(url):
+            subs.append((_URL_RE, r'''\1path: %s\2''' % url))
+        else:
+            subs.append((_URL_RE, r'''\1url: %s\2''' % url))
 
-        params[name] = value
+    for key, value in params.items():
+        subs.append((re.compile(_SET_TEMPLATE % re.escape(key), re.M),
+                     r'''\1'%s'\2''' % value))
 
-    # Write variables to recipe
-    out = []
-    with open(recipe, 'r') as recipe_file:
-        for line in recipe_file:
-
-            if 'sha256' in line:
-                continue
+    subs.append((_TRAILING_WS_RE, ''))
 
-            if url:
-                url = url.replace('\\', '/')
-                if os.path.isdir(url):
-                    line = re.sub(r'''^(\s+)(?:url|path):.*?(\s*#\s*\[.+?\]\s*)?$''',
-                                  r'''\1path: %s\2''' % url, line)
-                else:
-                    line = re.sub(r'''^(\s+)(?:url|path):.*?(\s*#\s*\[.+?\]\s*)?$''',
-                                  r'''\1url: %s\2''' % url, line)
-
-            for key, value in params.items():
-                if key == 'url':
-                    continue
-                line = re.sub(r'''^(\{%%\s*set\s+%s\s*=\s*)'[^']+'(\s*%%\}\s*)$''' % key,
-                              r'''\1'%s'\2''' % value, line)
+    with open(recipe, 'r') as recipe_file:
+        text = recipe_file.read()
 
-            out.append(line.rstrip())
+    # Write variables to recipe
+    for pattern, repl in subs:
+        text = pattern.sub(repl, text)
 
     # Write recipe file
     with open(recipe, 'w') as recipe_file:
-        recipe_file.write('\n'.join(out))
-        recipe_file.write('\n')
+        recipe_file.write(text)
 
 
 def get_version(pkg_dir):
     '''  Retrieve version number from setup.py '''
     with open(os.path.join(pkg_dir, 'DESCRIPTION'), 'r') as desc_in:
         for line in desc_in:
-            m = re.match(r'^Version\s*:\s*(\S+)', line)
+            if not line.startswith('Version'):
+                continue
+            m = _VERSION_RE.match(line)
             if m:
                 return m.group(1)
     raise RuntimeError('Could not find version in DESCRIPTION file.')
@@ -110,18 +97,32 @@ def redirect_stdout(target):
     sys.stdout = original
 
 
+@contextlib.contextmanager
+def open_archive(url):
+    ''' Open a local or remote tar file for a single streaming pass '''
+    if url.startswith('http:') or url.startswith('https:'):
+        with urlopen(url) as resp:
+            with tarfile.open(fileobj=resp, mode='r|*') as tar:
+                yield tar
+    else:
+        with tarfile.open(url, 'r|*') as tar:
+            yield tar
+
+
 def version_key(val):
     ''' Return normalized version number '''
     val = val.split('a')[0] + '.0.0'
-    return tuple([int(x) for x in re.findall(r'(\d+)', val)][:3])
+    return tuple([int(x) for x in _DIGITS_RE.findall(val)][:3])
 
 
 def expand_wildcards(vals):
     ''' Expand * in version numbers '''
     out = []
     for val in vals:
-        if re.search(r'\.?\*$', val):
-            val = re.sub(r'\.?\*$', '', val)
+        if val.endswith('*'):
+            val = val[:-1]
+            if val.endswith('.'):
+                val = val[:-1]
             next_val = [int(x) for x in val.split('.')]
             next_val[-1] += 1
             out.append('>={},<={}a0'.format(
@@ -140,7 +141,7 @@ def check_version(pkg_ver, specs):
         for ap in spec.split(','):
             or_expr = []
             for op in ap.split('|'):
-                oper, ver = re.findall(r'^([<>=!]*)(\S+)$', op)[0]
+                oper, ver = _SPEC_RE.match(op).groups()
                 if oper == '=':
                     oper = '=='
                 elif oper == '':
@@ -152,46 +153,100 @@ def check_version(pkg_ver, specs):
     return False
 
 
-def conda_search(platform, pkg):
-    ''' Return information about specified package '''
-    cmd = ['conda', 'search', '--json', '--platform', platform, pkg]
-    try:
-        out = json.loads(subprocess.check_output(cmd).decode('utf-8'))
-    except subprocess.CalledProcessError as exc:
-        out = json.loads(exc.output.decode('utf-8'))
-        if out and out.get('exception_name', '') == 'PackagesNotFoundError':
-            out = {}
-        else:
-            raise
-    return out.get(pkg.split('::')[-1], {})
+def conda_search(platform, *pkgs):
+    '''
+    Return information about specified packages
 
+    The searches are run as concurrent subprocesses since ``conda search``
+    only accepts a single package specification per invocation.
 
-def get_supported_versions(platform, r_base):
-    ''' Get the versions of R that can be used for SWAT '''
-    r_base_vers = set()
+    Parameters
+    ----------
+    platform : basestring
+        The Anaconda platform name to search
+    *pkgs : basestrings
+        Package specifications to search for
 
-    out = conda_search(platform, 'r::{}-base'.format(r_base))
+    Returns
+    -------
+    dict
+        Package specification / search results pairs
+
+    '''
+    procs = []
+    for pkg in pkgs:
+        cmd = ['conda', 'search', '--json', '--platform', platform, pkg]
+        procs.append((pkg, cmd, subprocess.Popen(cmd, stdout=subprocess.PIPE)))
+
+    results = {}
+    for pkg, cmd, proc in procs:
+        stdout = proc.communicate()[0]
+        out = json.loads(stdout)
+        if proc.returncode:
+            if out and out.get('exception_name', '') == 'PackagesNotFoundError':
+                out = {}
+            else:
+                raise subprocess.CalledProcessError(proc.returncode, cmd, output=stdout)
+        results[pkg] = out.get(pkg.split('::')[-1], {})
+
+    return results
+
+
+def get_supported_versions(platform, r_bases):
+    '''
+    Get the versions of R that can be used for SWAT
+
+    Parameters
+    ----------
+    platform : basestring
+        The Anaconda platform name to search
+    r_bases : list of basestrings
+        The R distributions to check (e.g., 'r', 'mro')
 
-    if not out:
+    Returns
+    -------
+    dict
+        R distribution / list of supported versions pairs
+
+    '''
+    pkgs = ['r::r-httr', 'r::r-jsonlite', 'r::r-testthat']
+    r_base_pkgs = ['r::{}-base'.format(x) for x in r_bases]
+
+    # The dependency searches are shared by all of the R distributions
+    results = conda_search(platform, *(r_base_pkgs + pkgs))
+
+    vers = {}
+    for r_base, r_base_pkg in zip(r_bases, r_base_pkgs):
+        vers[r_base] = _filter_supported_versions(r_base, results[r_base_pkg],
+                                                  {x: results[x] for x in pkgs})
+
+    return vers
+
+
+def _filter_supported_versions(r_base, r_base_info, pkg_infos):
+    ''' Return R versions supported by all of the given packages '''
+    r_base_vers = set()
+
+    if not r_base_info:
         return []
 
-    for item in out:
+    for item in r_base_info:
         ver = item['version']
         if tuple([int(x) for x in ver.split('.')]) < (3, 4, 3):
             continue
         r_base_vers.add(item['version'])
 
-    for pkg in ['r::r-httr', 'r::r-jsonlite', 'r::r-testthat']:
-        out = conda_search(platform, pkg)
+    prefix = '{}-base'.format(r_base)
+
+    for pkg, out in pkg_infos.items():
 
         pkg_vers = []
         for item in out:
-            rver = [x for x in item['depends'] if x.startswith('{}-base'.format(r_base))]
+            rver = next((x for x in item['depends'] if x.startswith(prefix)), None)
 
             if not rver:
                 continue
 
-            rver = rver[0]
             if rver == 'mro-base':
                 rver = 'mro-base ==3.4.3'
             rver = rver.split(' ')[-1]
@@ -206,6 +261,27 @@ def get_supported_versions(platform, r_base):
     return list(sorted(r_base_vers))
 
 
+def build_package(args, recipe_dir, base, ver, output_folder):
+    ''' Run conda build on the recipe for the given R distribution and version '''
+    env = dict(os.environ, R_BASE=base, R_VERSION=ver)
+
+    cmd = ['conda', 'build', '-q']  # '--no-test'
+    cmd.extend(['--R', ver])
+    if args.debug:
+        cmd.append('--debug')
+    if output_folder:
+        cmd.extend(['--output-folder', output_folder])
+    if args.override_channels:
+        cmd.append('--override-channels')
+    if args.channel:
+        for chan in args.channel:
+            cmd.extend(['--channel', chan])
+    cmd.append(recipe_dir)
+
+    print('> ' + ' '.join(cmd))
+    subprocess.check_call(cmd, env=env)
+
+
 open = io.open
 
 
@@ -220,31 +296,25 @@ def main(url, args):
     if os.path.isfile(args.recipe_dir):
         args.recipe_dir = os.path.dirname(args.recipe_dir)
 
-    download = False
     if url.startswith('http:') or url.startswith('https:'):
         print('> download %s' % url)
-        download = True
-        url = urlretrieve(url)[0]
-        urlcleanup()
     elif os.path.exists(url):
         url = os.path.abspath(url)
 
     with tempfile.TemporaryDirectory() as temp:
 
-        with tarfile.open(url, url.endswith('tar') and 'r:' or 'r:gz') as tar:
+        with open_archive(url) as tar:
             tar.extractall(temp)
 
-        # Clean up
-        if download:
-            urlcleanup()
-
-        url = glob.glob(os.path.join(temp, 'R-swat*'))[0]
+        url = next((x.path for x in os.scandir(temp) if x.name.startswith('R-swat')),
+                   None)
+        if url is None:
+            raise RuntimeError('Could not find R-swat directory in archive.')
 
         # Report available R versions
         print('')
         print('> Available verions for {}:'.format(args.platform))
-        vers = dict(r=get_supported_versions(args.platform, 'r'),
-                    mro=get_supported_versions(args.platform, 'mro'))
+        vers = get_supported_versions(args.platform, ['r', 'mro'])
         for key, value in vers.items():
             if value:
                 print('  + {}-base'.format(key))
@@ -256,41 +326,44 @@ def main(url, args):
         if 'R_LIBS_USER' in os.environ:
             del os.environ['R_LIBS_USER']
 
-        # Create conda package for each R version
+        pkg_version = get_version(url)
+
+        # Collect the R versions to create conda packages for
+        builds = []
         r_base_finished = set()
         for base, versions in vers.items():
-
-            os.environ['R_BASE'] = base
-
             for ver in versions:
 
                 # Only build for major.minor of r-base
                 if base == 'r':
-                    minor_ver = re.match(r'^(\d+\.\d+)', ver).group(1)
+                    minor_ver = _MINOR_VERSION_RE.match(ver).group(1)
                     if minor_ver in r_base_finished:
                         continue
                     r_base_finished.add(minor_ver)
 
-                update_recipe(args.recipe_dir, url=url, version=get_version(url),
-                              r_base='{}-base'.format(base), r_version=ver)
-
-                os.environ['R_VERSION'] = ver
-
-                cmd = ['conda', 'build', '-q']  # '--no-test'
-                cmd.extend(['--R', ver])
-                if args.debug:
-                    cmd.append('--debug')
-                if args.output_folder:
-                    cmd.extend(['--output-folder', args.output_folder])
-                if args.override_channels:
-                    cmd.append('--override-channels')
-                if args.channel:
-                    for chan in args.channel:
-                        cmd.extend(['--channel', chan])
-                cmd.append(args.recipe_dir)
+                builds.append((base, ver))
 
-                print('> ' + ' '.join(cmd))
-                subprocess.check_call(cmd)
+        # Create conda package for each R version
+        if args.jobs > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as pool:
+                futures = []
+                for base, ver in builds:
+                    # Each build gets its own recipe and output folder so that
+                    # concurrent builds don't overwrite each other's files
+                    name = '{}-base-{}'.format(base, ver)
+                    recipe_dir = shutil.copytree(args.recipe_dir,
+                                                 os.path.join(temp, 'recipe', name))
+                    update_recipe(recipe_dir, url=url, version=pkg_version,
+                                  r_base='{}-base'.format(base), r_version=ver)
+                    futures.append(pool.submit(build_package, args, recipe_dir, base, ver,
+                                               os.path.join(args.output_folder, name)))
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
+        else:
+            for base, ver in builds:
+                update_recipe(args.recipe_dir, url=url, version=pkg_version,
+                              r_base='{}-base'.format(base), r_version=ver)
+                build_package(args, args.recipe_dir, base, ver, args.output_folder)
 
 
 if __name__ == '__main__':
@@ -306,6 +379,10 @@ if __name__ == '__main__':
                       help='additional chanel to search')
     opts.add_argument('--debug', action='store_true',
                       help='enable conda build debug logging')
+    opts.add_argument('--jobs', '-j', default=1, type=int,
+                      help='number of conda builds to run concurrently; when greater '
+                           'than one, each build uses a copy of the recipe and a '
+                           'subdirectory of the output folder')
     opts.add_argument('--output-folder', type=str, default='',
                       help='folder to create the output package in')
     opts.add_argument('--override-channels', action='store_true', default=False,